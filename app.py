@@ -1,8 +1,15 @@
 import streamlit as st
-import torch
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
-import re
-import time
+from transformers import GPT2TokenizerFast
+from model_utils import GenerationBatcher, get_device, get_shared_batcher, load_gpt2_model, load_onnx_model, split_sentences
+
+# Seconds to wait for the shared batcher before giving up on a generation
+GENERATION_TIMEOUT = 300
+
+# Generation passes per request; passes after the first top up stories removed by filtering
+MAX_GENERATION_ATTEMPTS = 2
+
+# Models users can choose from, the first one is the default
+MODEL_OPTIONS = ["distilgpt2", "gpt2", "gpt2-medium"]
 
 # Configure page
 st.set_page_config(
@@ -71,53 +78,65 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-@st.cache_resource
-def load_model():
-    """Load and cache the GPT-2 model and tokenizer"""
+def create_batcher(model_name):
+    """Load the GPT-2 model and tokenizer behind a generation batcher"""
+    tokenizer = GPT2TokenizerFast.from_pretrained(model_name)
+    model = None
+    
+    # Prefer ONNX Runtime on CPU when optimum is installed
+    if get_device() == "cpu":
+        model = load_onnx_model(model_name)
+    
+    # load_gpt2_model already compiles with torch.compile on CUDA; avoid torch.jit.script,
+    # which is slower than eager for HF GPT-2
+    if model is None:
+        model = load_gpt2_model(model_name)
+    
+    # Add padding token
+    tokenizer.pad_token = tokenizer.eos_token
+    
+    # Prompts from concurrent sessions are generated together
+    return GenerationBatcher(model, tokenizer)
+
+@st.cache_resource(show_spinner=False, ttl=None, max_entries=len(MODEL_OPTIONS))
+def load_model(model_name="distilgpt2"):
+    """Load and cache the shared generation batcher"""
     try:
-        model_name = "gpt2"
-        tokenizer = GPT2Tokenizer.from_pretrained(model_name)
-        model = GPT2LMHeadModel.from_pretrained(model_name)
-        
-        # Add padding token
-        tokenizer.pad_token = tokenizer.eos_token
-        
-        return model, tokenizer
+        return get_shared_batcher(model_name, create_batcher)
     except Exception as e:
         st.error(f"Error loading model: {str(e)}")
-        return None, None
+        return None
 
-def generate_stories(input_text, model, tokenizer, num_stories=3, max_length=150, temperature=0.8):
-    """Generate multiple story continuations for the input text"""
+@st.cache_data(show_spinner=False)
+def generate_stories(input_text, num_stories=3, max_length=150, temperature=0.8, seed=0, model_name="distilgpt2"):
+    """Generate multiple story continuations for the input text, cached per prompt, settings and seed"""
     stories = []
     
-    try:
-        # Encode input text
-        input_ids = tokenizer.encode(input_text, return_tensors='pt')
+    for attempt in range(MAX_GENERATION_ATTEMPTS):
+        missing = num_stories - len(stories)
+        if missing <= 0:
+            break
         
-        # Generate multiple stories
-        for i in range(num_stories * 2):  # Generate more to filter better ones
-            with torch.no_grad():
-                outputs = model.generate(
-                    input_ids,
-                    max_length=input_ids.shape[1] + max_length,
-                    temperature=temperature,
-                    do_sample=True,
-                    top_k=50,
-                    top_p=0.95,
-                    pad_token_id=tokenizer.eos_token_id,
-                    num_return_sequences=1,
-                    repetition_penalty=1.1
-                )
-            
-            # Decode the generated text
-            generated_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
-            
-            # Extract only the new part (remove input text)
-            new_text = generated_text[len(input_text):].strip()
+        # Generate the missing stories in one batched pass
+        new_texts = load_model(model_name).generate(
+            input_text,
+            timeout=GENERATION_TIMEOUT,
+            num_return_sequences=missing,
+            max_new_tokens=max_length,
+            num_sentences=4,  # Stories keep at most 4 sentences, so stop decoding once they are complete
+            seed=seed * MAX_GENERATION_ATTEMPTS + attempt,  # Distinct seed per pass and per session seed
+            temperature=temperature,
+            do_sample=True,
+            top_k=50,
+            top_p=0.95,
+            repetition_penalty=1.1
+        )
+        
+        for new_text in new_texts:
+            new_text = new_text.strip()
             
             # Clean up the text and create story paragraphs
-            sentences = re.split(r'[.!?]+', new_text)
+            sentences = split_sentences(new_text)
             if len(sentences) >= 2:  # Ensure we have at least 2 sentences for a story
                 # Take first 3-4 sentences to form a story paragraph
                 story_sentences = [s.strip() for s in sentences[:4] if s.strip()]
@@ -125,12 +144,8 @@ def generate_stories(input_text, model, tokenizer, num_stories=3, max_length=150
                     clean_story = '. '.join(story_sentences) + '.'
                     if len(clean_story) > 50 and clean_story not in stories:  # Ensure minimum length and uniqueness
                         stories.append(clean_story)
-        
-        return stories[:num_stories]
     
-    except Exception as e:
-        st.error(f"Error generating stories: {str(e)}")
-        return []
+    return stories[:num_stories]
 
 @st.dialog("📚 Generated Stories")
 def show_stories_dialog(stories, input_text):
@@ -182,8 +197,17 @@ def show_stories_dialog(stories, input_text):
     
     with col2:
         if st.button("✨ Generate New Stories", use_container_width=True):
+            # A new seed bypasses the cached result for this prompt
+            st.session_state.story_seed += 1
+            st.session_state.regenerate_prompt = input_text
             st.rerun()
 
+def use_example_prompt():
+    """Copy the selected story starter into the prompt box and reset the picker"""
+    if st.session_state.example_prompt:
+        st.session_state.story_prompt = st.session_state.example_prompt
+        st.session_state.example_prompt = ""
+
 def main():
     # Header
     st.markdown("""
@@ -193,18 +217,28 @@ def main():
     </div>
     """, unsafe_allow_html=True)
     
+    # Sidebar for settings
+    st.sidebar.header("⚙️ Story Generation Settings")
+    model_name = st.sidebar.selectbox(
+        "Model",
+        options=MODEL_OPTIONS,
+        index=0,
+        help="DistilGPT-2 is about twice as fast, larger models write richer stories"
+    )
+    
     # Load model
-    with st.spinner("Loading GPT-2 model... This may take a moment on first run."):
-        model, tokenizer = load_model()
+    with st.spinner(f"Loading {model_name} model... This may take a moment on first run."):
+        batcher = load_model(model_name)
     
-    if model is None or tokenizer is None:
+    if batcher is None:
         st.error("Failed to load the model. Please refresh the page and try again.")
         return
     
-    st.success("✅ GPT-2 model loaded successfully!")
+    st.success(f"✅ {model_name} model loaded successfully!")
+    
+    if 'story_seed' not in st.session_state:
+        st.session_state.story_seed = 0
     
-    # Sidebar for settings
-    st.sidebar.header("⚙️ Story Generation Settings")
     temperature = st.sidebar.slider(
         "Creativity Level", 
         min_value=0.1, 
@@ -241,7 +275,8 @@ def main():
             "Enter your story beginning or prompt:",
             placeholder="Once upon a time, in a magical forest...",
             height=120,
-            help="Start your story with an interesting opening and let AI continue the narrative"
+            help="Start your story with an interesting opening and let AI continue the narrative",
+            key="story_prompt"
         )
         
         # Generate button
@@ -270,34 +305,42 @@ def main():
             "The antique music box began playing"
         ]
         
-        for example in example_prompts:
-            if st.button(example, key=f"example_{example}", use_container_width=True):
-                st.session_state.selected_example = example
-                st.rerun()
-        
-        # Handle example selection
-        if hasattr(st.session_state, 'selected_example'):
-            input_text = st.session_state.selected_example
-            del st.session_state.selected_example
+        st.selectbox(
+            "Pick a story starter:",
+            options=[""] + example_prompts,
+            format_func=lambda example: example or "—",
+            help="Copies the starter into the prompt box, where you can edit it",
+            key="example_prompt",
+            on_change=use_example_prompt
+        )
+    
+    # Handle regeneration requested from the stories dialog
+    if hasattr(st.session_state, 'regenerate_prompt'):
+        input_text = st.session_state.regenerate_prompt
+        generate_btn = True
+        del st.session_state.regenerate_prompt
     
     # Generate stories and show in dialog
     if generate_btn and input_text.strip():
         with st.spinner("🤖 AI is crafting your stories... Please wait..."):
-            # Add a small delay for better UX
-            time.sleep(2)
-            
-            stories = generate_stories(
-                input_text.strip(), 
-                model, 
-                tokenizer, 
-                num_stories=num_stories,
-                max_length=max_length,
-                temperature=temperature
-            )
+            try:
+                stories = generate_stories(
+                    input_text.strip(), 
+                    num_stories=num_stories,
+                    max_length=max_length,
+                    temperature=temperature,
+                    seed=st.session_state.story_seed,
+                    model_name=model_name
+                )
+            except Exception as e:
+                st.error(f"Error generating stories: {str(e)}")
+                stories = []
         
         if stories:
             show_stories_dialog(stories, input_text.strip())
         else:
+            # Move to a new seed so trying again samples fresh stories instead of the cached failure
+            st.session_state.story_seed += 1
             st.error("⚠️ Could not generate stories. Please try a different prompt or adjust the settings.")
     
     elif generate_btn and not input_text.strip():
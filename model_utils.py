@@ -2,9 +2,34 @@
 Utility functions for model operations and text processing
 """
 
-import re
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 import torch
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
+from transformers import GPT2LMHeadModel, GPT2TokenizerFast, StoppingCriteria, StoppingCriteriaList
+from transformers.pytorch_utils import Conv1D
+
+_SENT_END_TRANSLATION = str.maketrans({'!': '.', '?': '.'})
+
+# Generation passes per call; passes after the first top up predictions removed by filtering
+MAX_GENERATION_ATTEMPTS = 2
+
+_BATCHERS = {}
+_BATCHER_LOCK = threading.Lock()
+
+# Set once the user has been told that attention runs unfused
+_EAGER_ATTENTION_LOGGED = False
+
+# Cached but unused GPU memory above which it is handed back to the driver
+_EMPTY_CACHE_THRESHOLD = 1024 ** 3
+
+# Keyed weakly so tokenizers of models that were switched away from can be freed
+_SENTENCE_END_IDS = weakref.WeakKeyDictionary()
 
 class NextSentencePredictor:
     """
@@ -27,8 +52,8 @@ class NextSentencePredictor:
         """Load the GPT-2 model and tokenizer"""
         try:
             print(f"Loading {self.model_name} model...")
-            self.tokenizer = GPT2Tokenizer.from_pretrained(self.model_name)
-            self.model = GPT2LMHeadModel.from_pretrained(self.model_name)
+            self.tokenizer = GPT2TokenizerFast.from_pretrained(self.model_name)
+            self.model = load_gpt2_model(self.model_name)
             
             # Add padding token
             self.tokenizer.pad_token = self.tokenizer.eos_token
@@ -55,7 +80,7 @@ class NextSentencePredictor:
             text = text[len(input_text):].strip()
         
         # Split by sentence endings and take first complete sentence
-        sentences = re.split(r'[.!?]+', text)
+        sentences = split_sentences(text)
         
         if sentences and sentences[0].strip():
             # Clean up the sentence
@@ -79,7 +104,7 @@ class NextSentencePredictor:
         Args:
             input_text (str): Input text to complete
             num_predictions (int): Number of predictions to generate
-            max_length (int): Maximum length of generated text
+            max_length (int): Maximum number of new tokens to generate
             temperature (float): Sampling temperature
             top_k (int): Top-k sampling parameter
             top_p (float): Top-p sampling parameter
@@ -93,39 +118,52 @@ class NextSentencePredictor:
         predictions = []
         
         try:
-            # Encode input text
-            input_ids = self.tokenizer.encode(input_text, return_tensors='pt')
-            
-            for i in range(num_predictions * 2):  # Generate more to filter better ones
-                with torch.no_grad():
+            for attempt in range(MAX_GENERATION_ATTEMPTS):
+                missing = num_predictions - len(predictions)
+                if missing <= 0:
+                    break
+                
+                # Encode input text
+                inputs = move_to_device(self.tokenizer(input_text, return_tensors='pt'), self.model.device)
+                input_ids = inputs.input_ids
+                
+                # Generate the missing predictions in one batched pass
+                with torch.inference_mode():
                     outputs = self.model.generate(
                         input_ids,
-                        max_length=input_ids.shape[1] + max_length,
+                        attention_mask=inputs.attention_mask,
+                        max_new_tokens=max_length,
                         temperature=temperature,
                         do_sample=True,
                         top_k=top_k,
                         top_p=top_p,
                         pad_token_id=self.tokenizer.eos_token_id,
-                        num_return_sequences=1,
-                        repetition_penalty=1.1
+                        num_return_sequences=missing,
+                        repetition_penalty=1.1,
+                        use_cache=True,
+                        # Only the first sentence is kept, so stop decoding once it is complete
+                        stopping_criteria=StoppingCriteriaList([
+                            SentenceCountStop(self.tokenizer, 1, input_ids.shape[1])
+                        ])
                     )
                 
-                # Decode generated text
-                generated_text = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-                
-                # Clean the prediction
-                clean_prediction = self.clean_generated_text(generated_text, input_text)
+                # Decode generated texts
+                generated_texts = self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
                 
-                # Filter out very short or repetitive predictions
-                if (clean_prediction and 
-                    len(clean_prediction.split()) >= 3 and 
-                    clean_prediction not in predictions and
-                    len(clean_prediction) >= 10):
-                    predictions.append(clean_prediction)
+                # Free the generation tensors before post-processing
+                del inputs, input_ids, outputs
+                release_cached_memory()
                 
-                # Stop if we have enough good predictions
-                if len(predictions) >= num_predictions:
-                    break
+                for generated_text in generated_texts:
+                    # Clean the prediction
+                    clean_prediction = self.clean_generated_text(generated_text, input_text)
+                    
+                    # Filter out very short or repetitive predictions
+                    if (clean_prediction and 
+                        len(clean_prediction.split()) >= 3 and 
+                        clean_prediction not in predictions and
+                        len(clean_prediction) >= 10):
+                        predictions.append(clean_prediction)
             
             return predictions[:num_predictions]
         
@@ -133,6 +171,542 @@ class NextSentencePredictor:
             print(f"Error generating predictions: {str(e)}")
             return []
 
+class SentenceCountStop(StoppingCriteria):
+    """
+    Stop generation once every sequence has produced enough sentences
+    """
+    
+    def __init__(self, tokenizer, num_sentences, prompt_length):
+        """
+        Initialize the stopping criteria
+        
+        Args:
+            tokenizer (GPT2TokenizerFast): Tokenizer used for generation
+            num_sentences (int): Number of sentence endings to wait for
+            prompt_length (int): Number of prompt tokens to skip when counting
+        """
+        self.num_sentences = num_sentences
+        self.prompt_length = prompt_length
+        self.eos_token_id = tokenizer.eos_token_id
+        self.sentence_end_ids = get_sentence_end_ids(tokenizer)
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids[:, self.prompt_length:]
+        
+        # Copy the ids to the generation device once instead of on every step
+        if self.sentence_end_ids.device != generated.device:
+            self.sentence_end_ids = self.sentence_end_ids.to(generated.device)
+        
+        sentence_ends = torch.isin(generated, self.sentence_end_ids).sum(dim=1)
+        finished = generated.eq(self.eos_token_id).any(dim=1)
+        
+        return bool(((sentence_ends >= self.num_sentences) | finished).all())
+
+class GenerationBatcher:
+    """
+    Collect prompts submitted concurrently and generate them in shared batches
+    
+    Prompts that arrive within max_wait seconds of each other and use the same
+    generation settings are sorted by length, padded and passed to a single
+    generate call on a background thread.
+    """
+    
+    def __init__(self, model, tokenizer, max_batch_size=16, max_wait=0.05):
+        """
+        Initialize the batcher and start its worker thread
+        
+        Args:
+            model: Model to generate with
+            tokenizer (GPT2TokenizerFast): Tokenizer with a padding token set
+            max_batch_size (int): Maximum number of sequences per generate call
+            max_wait (float): Seconds to wait for more prompts before generating
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.closed = False
+        self.lock = threading.Lock()
+        
+        # Decoder-only models continue from the last position, so pad on the left
+        self.tokenizer.padding_side = "left"
+        
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+    
+    def submit(self, input_text, num_return_sequences=1, max_new_tokens=50, num_sentences=None, seed=None, **generate_kwargs):
+        """
+        Queue a prompt for generation
+        
+        Args:
+            input_text (str): Prompt to continue
+            num_return_sequences (int): Number of continuations to generate
+            max_new_tokens (int): Maximum number of new tokens to generate
+            num_sentences (int): Stop once this many sentences are complete
+            seed (int): Random seed for the batch; results only repeat when the
+                prompt is batched on its own with the same settings
+            **generate_kwargs: Sampling parameters passed on to generate
+            
+        Returns:
+            Future: Resolves to the list of generated continuations
+        """
+        future = Future()
+        settings = (num_return_sequences, max_new_tokens, num_sentences, seed, tuple(sorted(generate_kwargs.items())))
+        
+        # Settings group requests in the worker, so reject unhashable ones here
+        hash(settings)
+        
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Generation batcher has been closed")
+            if not self.worker.is_alive():
+                raise RuntimeError("Generation batcher worker has stopped")
+            self.requests.put((input_text, settings, future))
+        
+        return future
+    
+    def generate(self, input_text, timeout=None, **kwargs):
+        """
+        Queue a prompt for generation and wait for its continuations
+        
+        Args:
+            input_text (str): Prompt to continue
+            timeout (float): Seconds to wait before giving up, None to wait forever
+            **kwargs: Generation settings accepted by submit
+            
+        Returns:
+            list: Generated continuations
+        """
+        future = self.submit(input_text, **kwargs)
+        
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            # Nobody is waiting any more, so keep the worker from generating it later
+            future.cancel()
+            raise
+    
+    def close(self):
+        """Stop the worker thread once the prompts already queued are generated"""
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.requests.put(None)
+    
+    def _run(self):
+        """Worker loop that drains the queue and generates grouped batches"""
+        closing = False
+        
+        while not closing:
+            pending = [self.requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            
+            while pending[-1] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            
+            # close() queues None last, so it can only be the final item
+            if pending[-1] is None:
+                pending.pop()
+                closing = True
+            
+            # Only prompts with the same settings can share a generate call
+            groups = {}
+            for request in pending:
+                groups.setdefault(request[1], []).append(request)
+            
+            for settings, group in groups.items():
+                try:
+                    self._generate_group(group, settings)
+                except Exception as e:
+                    # Fail the remaining requests instead of letting the worker die
+                    for _, _, future in group:
+                        if not future.done():
+                            future.set_exception(e)
+    
+    def _generate_group(self, group, settings):
+        """Generate a group of prompts sharing the same settings in length-sorted batches"""
+        # Skip requests cancelled while queued; the rest can no longer be cancelled
+        group = [request for request in group if request[2].set_running_or_notify_cancel()]
+        
+        # Sorting by length keeps the padding within each batch small
+        lengths = [len(self.tokenizer.encode(input_text)) for input_text, _, _ in group]
+        group = [request for _, request in sorted(zip(lengths, group), key=lambda item: item[0])]
+        
+        prompts_per_batch = max(1, self.max_batch_size // settings[0])
+        for start in range(0, len(group), prompts_per_batch):
+            self._generate(group[start:start + prompts_per_batch], settings)
+    
+    def _generate(self, batch, settings):
+        """Generate continuations for a batch of prompts sharing the same settings"""
+        num_return_sequences, max_new_tokens, num_sentences, seed, generate_kwargs = settings
+        
+        inputs = move_to_device(self.tokenizer(
+            [input_text for input_text, _, _ in batch],
+            return_tensors='pt',
+            padding='longest'
+        ), self.model.device)
+        input_ids = inputs.input_ids
+        
+        stopping_criteria = StoppingCriteriaList()
+        if num_sentences:
+            stopping_criteria.append(SentenceCountStop(self.tokenizer, num_sentences, input_ids.shape[1]))
+        
+        # Seed a forked RNG so the process-wide generator is left untouched
+        fork_devices = [self.model.device] if self.model.device.type == "cuda" else []
+        with torch.random.fork_rng(devices=fork_devices, enabled=seed is not None):
+            if seed is not None:
+                torch.manual_seed(seed)
+            
+            with torch.inference_mode():
+                outputs = self.model.generate(
+                    input_ids,
+                    attention_mask=inputs.attention_mask,
+                    max_new_tokens=max_new_tokens,
+                    pad_token_id=self.tokenizer.eos_token_id,
+                    num_return_sequences=num_return_sequences,
+                    use_cache=True,
+                    stopping_criteria=stopping_criteria,
+                    **dict(generate_kwargs)
+                )
+        
+        # Decode only the new tokens; rows are grouped per prompt in submission order
+        generated_texts = self.tokenizer.batch_decode(outputs[:, input_ids.shape[1]:], skip_special_tokens=True)
+        
+        # Free the batch tensors before the next batch so GPU memory does not fragment
+        del inputs, input_ids, outputs
+        release_cached_memory()
+        
+        for i, (_, _, future) in enumerate(batch):
+            future.set_result(generated_texts[i * num_return_sequences:(i + 1) * num_return_sequences])
+
+def get_shared_batcher(model_name, load):
+    """
+    Get the process-wide generation batcher for a model, loading it on first use
+    
+    Streamlit re-executes the app script on every rerun, so the instances are
+    kept here to guarantee a single copy of each model per process even when
+    the Streamlit resource cache is bypassed. Each model keeps its own
+    batcher, so sessions using different models never unload each other's.
+    The lock only guards the lookup: a model is loaded outside it, and
+    sessions asking for the same model wait on its Future instead.
+    
+    Args:
+        model_name (str): Name of the model the batcher should run
+        load (callable): Function returning a new GenerationBatcher for model_name
+        
+    Returns:
+        GenerationBatcher: Shared batcher
+    """
+    with _BATCHER_LOCK:
+        future = _BATCHERS.get(model_name)
+        is_loader = future is None
+        if is_loader:
+            future = _BATCHERS[model_name] = Future()
+    
+    if is_loader:
+        try:
+            future.set_result(load(model_name))
+        except Exception as e:
+            # Forget the failed load so a later call can try again
+            with _BATCHER_LOCK:
+                del _BATCHERS[model_name]
+            future.set_exception(e)
+    
+    return future.result()
+
+def get_sentence_end_ids(tokenizer):
+    """
+    Get the ids of all tokens containing a sentence ending (., ! or ?)
+    
+    The vocabulary is scanned once per tokenizer and the result is cached.
+    
+    Args:
+        tokenizer (GPT2TokenizerFast): Tokenizer to look the tokens up in
+        
+    Returns:
+        torch.Tensor: Token ids
+    """
+    if tokenizer not in _SENTENCE_END_IDS:
+        _SENTENCE_END_IDS[tokenizer] = torch.tensor([
+            token_id for token, token_id in tokenizer.get_vocab().items()
+            if any(char in token for char in '.!?')
+        ])
+    
+    return _SENTENCE_END_IDS[tokenizer]
+
+def release_cached_memory():
+    """
+    Return cached GPU memory to the driver once too much of it sits unused
+    
+    Emptying the cache after every batch would make the next batch allocate
+    its memory from the driver again, so it only happens past a threshold.
+    """
+    if not torch.cuda.is_available():
+        return
+    
+    if torch.cuda.memory_reserved() - torch.cuda.memory_allocated() > _EMPTY_CACHE_THRESHOLD:
+        torch.cuda.empty_cache()
+
+def get_device():
+    """
+    Get the device to run the model on
+    
+    Returns:
+        str: "cuda" if a GPU is available, otherwise "cpu"
+    """
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def move_to_device(inputs, device):
+    """
+    Move encoded inputs to the device the model runs on
+    
+    GPU transfers go through pinned memory without blocking, so the copy is
+    queued ahead of the generation kernels instead of stalling the host.
+    
+    Args:
+        inputs (BatchEncoding): Tokenizer output
+        device (torch.device): Device to move the inputs to
+        
+    Returns:
+        BatchEncoding: Inputs on the device
+    """
+    if torch.device(device).type != "cuda":
+        return inputs.to(device)
+    
+    for key, tensor in inputs.items():
+        inputs[key] = tensor.pin_memory().to(device, non_blocking=True)
+    
+    return inputs
+
+def load_gpt2_model(model_name, device=None):
+    """
+    Load a GPT-2 model prepared for inference on the given device
+    
+    Attention runs through the fused scaled_dot_product_attention kernel where
+    supported. On CUDA the weights are loaded in FP16 and the forward pass is
+    compiled, on CPU they are quantized to INT8.
+    
+    Args:
+        model_name (str): Name of the GPT-2 model to load
+        device (str): Device to load the model on, detected if not given
+        
+    Returns:
+        torch.nn.Module: Model in eval mode with the KV cache enabled
+    """
+    device = device or get_device()
+    
+    load_kwargs = {"torch_dtype": torch.float16} if device == "cuda" else {}
+    
+    # Do not add torch.jit.script/trace here: TorchScript'd HF GPT-2 measures slower
+    # than eager. torch.compile below is the JIT path to use.
+    model = None
+    
+    # Use built-in SDPA attention when this transformers version supports it for GPT-2
+    if getattr(GPT2LMHeadModel, "_supports_sdpa", False):
+        try:
+            model = GPT2LMHeadModel.from_pretrained(model_name, attn_implementation="sdpa", **load_kwargs)
+        except ValueError as e:
+            print(f"SDPA attention unavailable, using BetterTransformer: {str(e)}")
+    
+    if model is None:
+        model = to_bettertransformer(GPT2LMHeadModel.from_pretrained(model_name, **load_kwargs))
+    
+    if device == "cuda":
+        model = model.to(device)
+    else:
+        model = quantize_model(model)
+    
+    # Inference only: disable dropout and reuse past key/values while decoding
+    model.eval()
+    model.config.use_cache = True
+    
+    if device == "cuda":
+        compile_model(model, device)
+    
+    return model
+
+def compile_model(model, device):
+    """
+    Compile the model's forward pass with torch.compile, keeping eager mode if that fails
+    
+    The forward pass is compiled rather than the module so generate() picks it
+    up. The KV cache grows every step, so shapes are marked dynamic to avoid
+    recompiling per step; this rules out CUDA graphs, so the default mode is
+    used. Compilation is lazy, so a short warm-up generation runs here instead
+    of on the first request.
+    
+    Args:
+        model (GPT2LMHeadModel): Model to compile in place
+        device (str): Device the model is on
+    """
+    eager_forward = model.forward
+    
+    try:
+        model.forward = torch.compile(model.forward, dynamic=True)
+        
+        warmup_ids = torch.tensor([[model.config.eos_token_id]], device=device)
+        with torch.inference_mode():
+            model.generate(
+                warmup_ids,
+                attention_mask=torch.ones_like(warmup_ids),
+                max_new_tokens=2,
+                pad_token_id=model.config.eos_token_id
+            )
+    except Exception as e:
+        # torch.compile is unsupported on some platforms (e.g. Python 3.11+ or Windows on torch 2.0)
+        print(f"torch.compile unavailable, running eager: {str(e)}")
+        model.forward = eager_forward
+
+def to_bettertransformer(model):
+    """
+    Swap the model's attention for optimum's fused BetterTransformer layers
+    
+    Args:
+        model (GPT2LMHeadModel): Model to transform
+        
+    Returns:
+        GPT2LMHeadModel: Transformed model, or the original if optimum is not
+        installed or cannot transform it
+    """
+    try:
+        from optimum.bettertransformer import BetterTransformer
+        return BetterTransformer.transform(model)
+    except ImportError:
+        log_eager_attention("install requirements-optional.txt for fused attention")
+    except Exception as e:
+        log_eager_attention(f"BetterTransformer failed: {str(e)}")
+    
+    return model
+
+def log_eager_attention(reason):
+    """
+    Tell the user, once per process, that attention is not fused
+    
+    Args:
+        reason (str): Why neither SDPA nor BetterTransformer could be used
+    """
+    global _EAGER_ATTENTION_LOGGED
+    
+    if not _EAGER_ATTENTION_LOGGED:
+        _EAGER_ATTENTION_LOGGED = True
+        print(f"Using eager attention ({reason})")
+
+def load_onnx_model(model_name, cache_dir="onnx_models"):
+    """
+    Load GPT-2 as an ONNX Runtime model with fused attention kernels
+    
+    The model is exported and optimized on first use and the result is saved
+    under cache_dir, so later runs load it straight from disk. The export is
+    written to a temporary directory and only moved into place once it is
+    complete, so an interrupted export is redone on the next run.
+    
+    Args:
+        model_name (str): Name of the GPT-2 model to load
+        cache_dir (str): Directory to store exported models in
+        
+    Returns:
+        ORTModelForCausalLM: ONNX Runtime model, or None if optimum is not
+        installed or the export fails
+    """
+    try:
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForCausalLM, ORTOptimizer
+        from optimum.onnxruntime.configuration import OptimizationConfig
+    except ImportError:
+        return None
+    except Exception as e:
+        # optimum imports lazily, so a broken transitive dependency surfaces as RuntimeError
+        print(f"Error importing ONNX Runtime support, falling back to PyTorch: {str(e)}")
+        return None
+    
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = os.cpu_count() or 1
+    
+    export_dir = os.path.join(cache_dir, model_name)
+    tmp_dir = None
+    
+    try:
+        if not os.path.isdir(export_dir):
+            print(f"Exporting {model_name} to ONNX...")
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+            
+            # ORTOptimizer does not support merged decoders
+            model = ORTModelForCausalLM.from_pretrained(model_name, export=True, use_cache=True, use_merged=False)
+            
+            # Level 2 applies the GPT-2 attention and layer norm fusions
+            optimizer = ORTOptimizer.from_pretrained(model)
+            optimizer.optimize(save_dir=tmp_dir, optimization_config=OptimizationConfig(optimization_level=2))
+            
+            os.replace(tmp_dir, export_dir)
+            tmp_dir = None
+        
+        return ORTModelForCausalLM.from_pretrained(
+            export_dir,
+            use_cache=True,
+            use_merged=False,
+            session_options=session_options
+        )
+    except Exception as e:
+        print(f"Error loading ONNX model, falling back to PyTorch: {str(e)}")
+        return None
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def quantize_model(model):
+    """
+    Apply dynamic INT8 quantization to the model for faster CPU inference
+    
+    GPT-2 implements its attention and MLP projections with the HuggingFace
+    Conv1D layer, which quantize_dynamic does not recognise, so those layers
+    are first swapped for equivalent nn.Linear layers.
+    
+    Args:
+        model (GPT2LMHeadModel): Model to quantize
+        
+    Returns:
+        torch.nn.Module: Quantized model
+    """
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, name, linear)
+    
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def split_sentences(text):
+    """
+    Split text on runs of sentence endings (., ! and ?)
+    
+    Equivalent to re.split(r'[.!?]+', text) without going through the regex
+    engine: empty pieces between consecutive endings are dropped, leading and
+    trailing empty pieces are kept.
+    
+    Args:
+        text (str): Text to split
+        
+    Returns:
+        list: Sentence pieces
+    """
+    parts = text.translate(_SENT_END_TRANSLATION).split('.')
+    
+    if len(parts) <= 2:
+        return parts
+    
+    return [parts[0]] + [part for part in parts[1:-1] if part] + [parts[-1]]
+
 def validate_input(text):
     """
     Validate input text
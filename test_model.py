@@ -2,8 +2,15 @@
 Test script for the Next Sentence Prediction model
 """
 
-from model_utils import NextSentencePredictor, validate_input, get_example_sentences
+from model_utils import (
+    GenerationBatcher, NextSentencePredictor, SentenceCountStop,
+    get_example_sentences, load_gpt2_model, split_sentences, validate_input
+)
+from transformers import GPT2TokenizerFast
+import re
+import threading
 import time
+import torch
 
 def test_model_loading():
     """Test if the model loads correctly"""
@@ -66,6 +73,106 @@ def test_input_validation():
         status = "✅" if is_valid == expected else "❌"
         print(f"{status} '{text[:20]}...' - Valid: {is_valid}")
 
+def test_sentence_splitting():
+    """Test that sentence splitting matches the regex it replaces"""
+    print("\nTesting sentence splitting...")
+    
+    test_cases = [
+        "",
+        "No sentence ending here",
+        "One sentence.",
+        "First. Second! Third? Fourth",
+        "Wait... what?! Really.",
+        "...leading and trailing!!",
+        "?!.",
+    ]
+    
+    for text in test_cases:
+        matches = split_sentences(text) == re.split(r'[.!?]+', text)
+        status = "✅" if matches else "❌"
+        print(f"{status} '{text[:20]}'")
+
+def test_sentence_count_stop():
+    """Test that generation stops on the Nth sentence ending or on EOS"""
+    print("\nTesting sentence count stopping...")
+    
+    tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
+    prompt = tokenizer.encode("The sky was red.")
+    word = tokenizer.encode(" Then")
+    period, exclamation, question = (tokenizer.encode(char)[0] for char in ".!?")
+    eos = tokenizer.eos_token_id
+    
+    stop = SentenceCountStop(tokenizer, 3, len(prompt))
+    
+    def stops(*rows):
+        return stop(torch.tensor([prompt + row for row in rows]), None)
+    
+    test_cases = [
+        ("Prompt endings are not counted", stops(word * 3), False),
+        ("Two of three endings", stops(word + [period] + word + [exclamation] + word), False),
+        ("Third ending reached", stops(word + [period] + word + [exclamation] + word + [question]), True),
+        ("EOS before enough endings", stops(word + [period] + [eos] * 3), True),
+        ("One sequence still running", stops([period, exclamation, question], word + [period] + word), False),
+        ("All sequences finished", stops([period, exclamation, question], word + [eos] + [eos]), True),
+    ]
+    
+    for name, result, expected in test_cases:
+        status = "✅" if result == expected else "❌"
+        print(f"{status} {name} - Stopped: {result}")
+
+def test_batcher():
+    """Test that concurrent prompts are batched and each gets its own continuations"""
+    print("\nTesting generation batcher...")
+    
+    tokenizer = GPT2TokenizerFast.from_pretrained("distilgpt2")
+    tokenizer.pad_token = tokenizer.eos_token
+    batcher = GenerationBatcher(load_gpt2_model("distilgpt2"), tokenizer)
+    
+    prompts = [
+        "Hello",
+        "The weather today is",
+        "Once upon a time, in a small village far away, there lived",
+        "I went to the store to"
+    ]
+    greedy = dict(max_new_tokens=8, do_sample=False)
+    sampled = dict(num_return_sequences=3, max_new_tokens=8, do_sample=True, seed=0)
+    
+    # Greedy continuations generated one prompt at a time, without padding
+    expected = {prompt: batcher.submit(prompt, **greedy).result(timeout=120) for prompt in prompts}
+    
+    # Submit every prompt from its own thread so they share padded batches
+    futures = {}
+    
+    def submit_all(prompt):
+        futures[prompt] = (batcher.submit(prompt, **greedy), batcher.submit(prompt, **sampled))
+    
+    threads = [threading.Thread(target=submit_all, args=(prompt,)) for prompt in prompts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    for prompt in prompts:
+        greedy_future, sampled_future = futures[prompt]
+        own_prompt = greedy_future.result(timeout=120) == expected[prompt]
+        sequence_count = len(sampled_future.result(timeout=120))
+        status = "✅" if own_prompt and sequence_count == 3 else "❌"
+        print(f"{status} '{prompt[:20]}' - Own continuation: {own_prompt}, Sequences: {sequence_count}")
+    
+    # Closing generates what is already queued and rejects anything after
+    pending = [batcher.submit(prompt, **sampled) for prompt in prompts]
+    batcher.close()
+    
+    drained = all(len(future.result(timeout=120)) == 3 for future in pending)
+    print(f"{'✅' if drained else '❌'} Queued prompts generated after close")
+    
+    try:
+        batcher.submit(prompts[0], **sampled)
+        rejected = False
+    except RuntimeError:
+        rejected = True
+    print(f"{'✅' if rejected else '❌'} Submit rejected after close")
+
 def main():
     """Run all tests"""
     print("🧪 Running Next Sentence Prediction Tests\n")
@@ -77,9 +184,18 @@ def main():
     # Test input validation
     test_input_validation()
     
+    # Test sentence splitting
+    test_sentence_splitting()
+    
+    # Test sentence count stopping
+    test_sentence_count_stop()
+    
     # Test predictions
     test_predictions()
     
+    # Test generation batcher
+    test_batcher()
+    
     print("\n🎉 All tests completed!")
 
 if __name__ == "__main__":